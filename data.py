@@ -1,4 +1,6 @@
+import os
 import os.path as osp
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 import transformers
@@ -24,12 +26,13 @@ def file_to_ids(file_path):
 
     Returns: dict, mapping str to ID (int)
     """
-    str2id = dict()
+    # Split the whole file at once instead of iterating line by line
     with open(file_path) as file:
-        for i, line in enumerate(file):
-            str2id[line.strip()] = i
+        lines = file.read().split('\n')
+    if lines[-1] == '':
+        lines.pop()
 
-    return str2id
+    return {line.strip(): i for i, line in enumerate(lines)}
 
 
 def get_negative_sampling_indices(batch_size, num_negatives, repeats=1):
@@ -199,12 +202,15 @@ class TextGraphDataset(GraphDataset):
         if max_len is None:
             max_len = tokenizer.max_len
 
-        cached_text_path = osp.join(self.directory, 'text_data.pt')
+        # Token IDs are cached as int32 in a .npy file, which is memory-mapped
+        # when loaded so that rows are only read from disk when indexed
+        cached_text_path = osp.join(self.directory, 'text_data.npy')
         need_to_load_text = True
         if use_cached_text:
             logger = logging.getLogger()
             if osp.exists(cached_text_path):
-                self.text_data = torch.load(cached_text_path)
+                text_data = np.load(cached_text_path, mmap_mode='c')
+                self.text_data = torch.from_numpy(text_data)
                 logger.info(f'Loaded cached text data for'
                             f' {self.text_data.shape[0]} entities,'
                             f' and maximum length {self.text_data.shape[1]}.')
@@ -214,7 +220,7 @@ class TextGraphDataset(GraphDataset):
 
         if need_to_load_text:
             self.text_data = torch.zeros((len(ent_ids), max_len + 1),
-                                         dtype=torch.long)
+                                         dtype=torch.int)
             read_entities = set()
             progress = tqdm(desc='Reading entity descriptions',
                             total=len(ent_ids), mininterval=5)
@@ -264,12 +270,16 @@ class TextGraphDataset(GraphDataset):
                 raise ValueError(f'Some entries in text_data contain'
                                  f' length-0 descriptions.')
 
-            torch.save(self.text_data,
-                       osp.join(self.directory, 'text_data.pt'))
+            # Write to a new file and move it into place, so that runs that
+            # have the previous cache memory-mapped keep reading the old file
+            tmp_path = f'{cached_text_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, self.text_data.numpy())
+            os.replace(tmp_path, cached_text_path)
 
     def get_entity_description(self, ent_ids):
         """Get entity descriptions for a tensor of entity IDs."""
-        text_data = self.text_data[ent_ids]
+        text_data = self.text_data[ent_ids].long()
         text_end_idx = text_data.shape[-1] - 1
 
         # Separate tokens from lengths
@@ -281,6 +291,13 @@ class TextGraphDataset(GraphDataset):
 
         return text_tok, text_mask, text_len
 
+    def collate_entity_ids(self, ent_ids):
+        """Given a tensor with a batch of entity IDs, return their
+        descriptions. Use as a collate_fn for a DataLoader over a tensor of
+        entity IDs, with batch_size=None and a BatchSampler.
+        """
+        return self.get_entity_description(ent_ids)
+
     def collate_fn(self, data_list):
         """Given a batch of triples, return it in the form of
         entity descriptions, and the relation types between them.
@@ -8,6 +8,10 @@ from collections import Counter, defaultdict
 import torch
 import rdflib
 
+# Buffer size for large output files, so that writing them line by line
+# flushes to disk in 1 MiB blocks
+WRITE_BUFFER_SIZE = 1 << 20
+
 
 def parse_triples(triples_file):
     """Read a file containing triples, with head, relation, and tail
@@ -183,13 +187,15 @@ def drop_entities(triples_file, train_size=0.8, valid_size=0.1, test_size=0.1,
             continue
 
         # Save file with triples for entities in set
-        with open(osp.join(dirname, f'{prefix}{set_name}.tsv'), 'w') as file:
+        with open(osp.join(dirname, f'{prefix}{set_name}.tsv'), 'w',
+                  buffering=WRITE_BUFFER_SIZE) as file:
             for entity in entity_set:
                 triples = dropped_edges[entity]
                 for head, tail, rel in triples:
                     file.write(f'{head}\t{rel}\t{tail}\n')
 
-    with open(osp.join(dirname, f'{prefix}train.tsv'), 'w') as train_file:
+    with open(osp.join(dirname, f'{prefix}train.tsv'), 'w',
+              buffering=WRITE_BUFFER_SIZE) as train_file:
         for head, tail, rel in graph.edges(data=True):
             train_file.write(f'{head}\t{rel["weight"]}\t{tail}\n')
 
@@ -333,7 +339,8 @@ def get_ranking_descriptions(run_file, dbpedia_file, redirects_file):
 
     read_entities = set()
     progress = tqdm(file=sys.stdout)
-    with open(dbpedia_file) as f, open(output_file, 'w') as out:
+    with open(dbpedia_file) as f, open(output_file, 'w',
+                                       buffering=WRITE_BUFFER_SIZE) as out:
         for line in f:
             g = rdflib.Graph().parse(data=line, format='n3')
             for (page, rel, description) in g:
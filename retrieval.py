@@ -135,21 +135,33 @@ def embed_entities(dim, model, rel_model, max_len, emb_batch_size, checkpoint,
     return ent_embeddings, entity2idx, encoder, tokenizer
 
 
-def rerank_on_fold(fold, qrels, baseline_run, id2query, tokenizer, encoder,
-                   entity2idx, ent_embeddings, alpha, drop_stopwords):
-    train_run = dict()
-    qrel_run = dict()
-    for query_id in fold:
-        results = baseline_run[query_id]
-
-        # Encode query
+def embed_queries(id2query, query_ids, tokenizer, encoder, drop_stopwords):
+    """Encode the given queries once, instead of on every reranking pass.
+    Queries are encoded one at a time without padding, since padding changes
+    the output of some encoders (e.g. DKRL).
+
+    Returns: dict, mapping query ID to a (1, dim) tensor with its embedding.
+    """
+    query_embeddings = dict()
+    for query_id in query_ids:
         query = id2query[query_id]
         if drop_stopwords:
             query = remove_stopwords(query)
         query_tokens = tokenizer.encode(query, return_tensors='pt',
                                         max_length=64)
-        query_embedding = encoder.encode(query_tokens.to(device),
-                                         text_mask=None)
+        query_embeddings[query_id] = encoder.encode(query_tokens.to(device),
+                                                    text_mask=None)
+
+    return query_embeddings
+
+
+def rerank_on_fold(fold, qrels, baseline_run, query_embeddings, entity2idx,
+                   ent_embeddings, alpha):
+    train_run = dict()
+    qrel_run = dict()
+    for query_id in fold:
+        results = baseline_run[query_id]
+        query_embedding = query_embeddings[query_id]
 
         # Get embeddings of entities to rerank for this query
         ent_ids_to_rerank = []
@@ -240,6 +252,14 @@ def rerank(model, rel_model, run_file, queries_file, qrels_file, folds_file,
     baseline_run = new_baseline_run
     qrels = new_qrels
 
+    # Encode only the queries used in the folds
+    fold_queries = set()
+    for fold in folds.values():
+        fold_queries.update(fold['training'])
+        fold_queries.update(fold['testing'])
+    query_embeddings = embed_queries(id2query, fold_queries, tokenizer,
+                                     encoder, drop_stopwords)
+
     # Choose best reranking on training set
     alpha_choices = np.linspace(0, 1, 20)
     test_run = dict()
@@ -250,9 +270,8 @@ def rerank(model, rel_model, run_file, queries_file, qrels_file, folds_file,
         best_alpha = alpha_choices[0]
         for alpha in alpha_choices:
             result, _ = rerank_on_fold(train_queries, qrels,
-                                       baseline_run, id2query, tokenizer,
-                                       encoder, entity2idx, ent_embeddings,
-                                       alpha, drop_stopwords)
+                                       baseline_run, query_embeddings,
+                                       entity2idx, ent_embeddings, alpha)
             if result > best_result:
                 best_result = result
                 best_alpha = alpha
@@ -263,10 +282,9 @@ def rerank(model, rel_model, run_file, queries_file, qrels_file, folds_file,
 
         test_queries = fold['testing']
         fold_mean, fold_run = rerank_on_fold(test_queries, qrels,
-                                             baseline_run, id2query,
-                                             tokenizer, encoder, entity2idx,
-                                             ent_embeddings, best_alpha,
-                                             drop_stopwords)
+                                             baseline_run, query_embeddings,
+                                             entity2idx, ent_embeddings,
+                                             best_alpha)
 
         _log.info(f'Test fold result: {fold_mean:.3f}')
 
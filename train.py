@@ -3,7 +3,7 @@ import os.path as osp
 import networkx as nx
 import torch
 from torch.optim import Adam
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 from sacred.run import Run
 from logging import Logger
 from sacred import Experiment
@@ -52,15 +52,18 @@ def config():
     max_epochs = 40
     checkpoint = None
     use_cached_text = False
+    fp16_eval = False
+    score_chunk_size = 16384
+    emb_num_workers = 4
 
 
 @ex.capture
 @torch.no_grad()
 def eval_link_prediction(model, triples_loader, text_dataset, entities,
-                         epoch, emb_batch_size, _run: Run, _log: Logger,
-                         prefix='', max_num_batches=None,
-                         filtering_graph=None, new_entities=None,
-                         return_embeddings=False):
+                         epoch, emb_batch_size, fp16_eval, score_chunk_size,
+                         emb_num_workers, _run: Run, _log: Logger, prefix='',
+                         max_num_batches=None, filtering_graph=None,
+                         new_entities=None, return_embeddings=False):
     compute_filtered = filtering_graph is not None
     mrr_by_position = torch.zeros(3, dtype=torch.float).to(device)
     mrr_pos_counts = torch.zeros_like(mrr_by_position)
@@ -71,10 +74,13 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
 
     hit_positions = [1, 3, 10]
     k_values = torch.tensor([hit_positions], device=device)
-    hits_at_k = {pos: 0.0 for pos in hit_positions}
-    mrr = 0.0
-    mrr_filt = 0.0
-    hits_at_k_filt = {pos: 0.0 for pos in hit_positions}
+    # Metrics are accumulated on the device in double precision (as the sums
+    # of Python floats they replace), and copied back only at the end
+    hits_at_k = torch.zeros(len(hit_positions), dtype=torch.double,
+                            device=device)
+    mrr = torch.zeros((), dtype=torch.double, device=device)
+    mrr_filt = torch.zeros_like(mrr)
+    hits_at_k_filt = torch.zeros_like(hits_at_k)
 
     if device != torch.device('cpu'):
         model = model.module
@@ -92,33 +98,48 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
         ent2idx = torch.arange(num_entities)
         entities = ent2idx
 
-    # Create embedding lookup table for evaluation
-    ent_emb = torch.zeros((num_entities, model.dim), dtype=torch.float,
+    # Create embedding lookup table for evaluation. In half precision it
+    # takes half the memory, and scoring all entities reads half the bytes.
+    use_cuda = device != torch.device('cpu')
+    emb_dtype = torch.half if fp16_eval and use_cuda else torch.float
+    ent_emb = torch.empty((num_entities, model.dim), dtype=emb_dtype,
                           device=device)
-    idx = 0
-    num_iters = np.ceil(num_entities / emb_batch_size)
-    iters_count = 0
-    while idx < num_entities:
-        # Get a batch of entity IDs and encode them
-        batch_ents = entities[idx:idx + emb_batch_size]
 
+    # Entity descriptions are gathered by workers (if emb_num_workers > 0),
+    # so that batches are prepared and copied to pinned memory while the
+    # encoder runs
+    if isinstance(model, models.InductiveLinkPrediction):
+        collate_fn = text_dataset.collate_entity_ids
+        num_workers = emb_num_workers
+    else:
+        collate_fn = None
+        num_workers = 0
+    # Batches of entity IDs are taken with a single index into entities
+    batch_sampler = BatchSampler(SequentialSampler(entities), emb_batch_size,
+                                 drop_last=False)
+    ent_loader = DataLoader(entities, batch_size=None, sampler=batch_sampler,
+                            collate_fn=collate_fn, num_workers=num_workers,
+                            pin_memory=use_cuda)
+
+    idx = 0
+    num_iters = len(ent_loader)
+    for iters_count, batch in enumerate(ent_loader, start=1):
         if isinstance(model, models.InductiveLinkPrediction):
             # Encode with entity descriptions
-            data = text_dataset.get_entity_description(batch_ents)
-            text_tok, text_mask, text_len = data
-            batch_emb = model(text_tok.unsqueeze(1).to(device),
-                              text_mask.unsqueeze(1).to(device))
+            text_tok, text_mask, text_len = batch
+            text_tok = text_tok.to(device, non_blocking=True)
+            text_mask = text_mask.to(device, non_blocking=True)
+            batch_emb = model(text_tok.unsqueeze(1), text_mask.unsqueeze(1))
         else:
             # Encode from lookup table
-            batch_emb = model(batch_ents)
+            batch_emb = model(batch.to(device, non_blocking=True))
 
-        ent_emb[idx:idx + batch_ents.shape[0]] = batch_emb
+        batch_size = batch_emb.shape[0]
+        ent_emb[idx:idx + batch_size] = batch_emb
+        idx += batch_size
 
-        iters_count += 1
         if iters_count % np.ceil(0.2 * num_iters) == 0:
-            _log.info(f'[{idx + batch_ents.shape[0]:,}/{num_entities:,}]')
-
-        idx += emb_batch_size
+            _log.info(f'[{idx:,}/{num_entities:,}]')
 
     ent_emb = ent_emb.unsqueeze(0)
 
@@ -140,21 +161,23 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
         # Embed triple
         head_embs = ent_emb.squeeze()[heads]
         tail_embs = ent_emb.squeeze()[tails]
-        rel_embs = model.rel_emb(rels.to(device))
+        rel_embs = model.rel_emb(rels.to(device)).to(emb_dtype)
 
         # Score all possible heads and tails
-        heads_predictions = model.score_fn(ent_emb, tail_embs, rel_embs)
-        tails_predictions = model.score_fn(head_embs, ent_emb, rel_embs)
-
-        pred_ents = torch.cat((heads_predictions, tails_predictions))
+        heads_predictions = utils.score_all_entities(
+            model.score_fn, ent_emb, tail_embs, rel_embs, predict_heads=True,
+            chunk_size=score_chunk_size)
+        tails_predictions = utils.score_all_entities(
+            model.score_fn, ent_emb, head_embs, rel_embs, predict_heads=False,
+            chunk_size=score_chunk_size)
+
+        pred_ents = torch.cat((heads_predictions, tails_predictions)).float()
         true_ents = torch.cat((heads, tails))
 
         num_predictions += pred_ents.shape[0]
         reciprocals, hits = utils.get_metrics(pred_ents, true_ents, k_values)
-        mrr += reciprocals.sum().item()
-        hits_sum = hits.sum(dim=0)
-        for j, k in enumerate(hit_positions):
-            hits_at_k[k] += hits_sum[j].item()
+        mrr += reciprocals.sum().double()
+        hits_at_k += hits.sum(dim=0).double()
 
         if compute_filtered:
             filters = utils.get_triple_filters(triples, filtering_graph,
@@ -165,10 +188,8 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
             pred_ents[filter_mask] = pred_ents.min() - 1.0
 
             reciprocals, hits = utils.get_metrics(pred_ents, true_ents, k_values)
-            mrr_filt += reciprocals.sum().item()
-            hits_sum = hits.sum(dim=0)
-            for j, k in enumerate(hit_positions):
-                hits_at_k_filt[k] += hits_sum[j].item()
+            mrr_filt += reciprocals.sum().double()
+            hits_at_k_filt += hits.sum(dim=0).double()
 
             reciprocals = reciprocals.squeeze()
             if new_entities is not None:
@@ -191,12 +212,13 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
             _log.info(f'[{i + 1:,}/{total:,}]')
 
     _log.info(f'The total number of predictions is {num_predictions:,}')
-    for hits_dict in (hits_at_k, hits_at_k_filt):
-        for k in hits_dict:
-            hits_dict[k] /= num_predictions
+    hits_at_k = dict(zip(hit_positions,
+                         (hits_at_k / num_predictions).tolist()))
+    hits_at_k_filt = dict(zip(hit_positions,
+                              (hits_at_k_filt / num_predictions).tolist()))
 
-    mrr = mrr / num_predictions
-    mrr_filt = mrr_filt / num_predictions
+    mrr = mrr.item() / num_predictions
+    mrr_filt = mrr_filt.item() / num_predictions
 
     log_str = f'{prefix} mrr: {mrr:.4f}  '
     _run.log_scalar(f'{prefix}_mrr', mrr, epoch)
@@ -236,7 +258,7 @@ def eval_link_prediction(model, triples_loader, text_dataset, entities,
             _log.info(log_str)
 
     if return_embeddings:
-        out = (mrr, ent_emb)
+        out = (mrr, ent_emb.float())
     else:
         out = (mrr, None)
 
@@ -339,7 +361,9 @@ def link_prediction(dataset, inductive, dim, model, rel_model, loss_fn,
     best_valid_mrr = 0.0
     checkpoint_file = osp.join(OUT_PATH, f'model-{_run._id}.pt')
     for epoch in range(1, max_epochs + 1):
-        train_loss = 0
+        # Accumulate on the device (in double precision, as the sum of Python
+        # floats it replaces) to avoid a sync at every step
+        train_loss = torch.zeros((), dtype=torch.double, device=device)
         for step, data in enumerate(train_loader):
             loss = model(*data).mean()
 
@@ -349,14 +373,16 @@ def link_prediction(dataset, inductive, dim, model, rel_model, loss_fn,
             if use_scheduler:
                 scheduler.step()
 
-            train_loss += loss.item()
+            train_loss += loss.detach().double()
 
             if step % int(0.05 * len(train_loader)) == 0:
+                batch_loss = loss.item()
                 _log.info(f'Epoch {epoch}/{max_epochs} '
-                          f'[{step}/{len(train_loader)}]: {loss.item():.6f}')
-                _run.log_scalar('batch_loss', loss.item())
+                          f'[{step}/{len(train_loader)}]: {batch_loss:.6f}')
+                _run.log_scalar('batch_loss', batch_loss)
 
-        _run.log_scalar('train_loss', train_loss / len(train_loader), epoch)
+        train_loss = train_loss.item() / len(train_loader)
+        _run.log_scalar('train_loss', train_loss, epoch)
 
         if dataset != 'Wikidata5M':
             _log.info('Evaluating on sample of training set')
@@ -83,6 +83,38 @@ def get_triple_filters(triples, graph, num_ents, ent2idx):
     return heads_filter, tails_filter
 
 
+def score_all_entities(score_fn, ent_emb, embs, rels, predict_heads,
+                       chunk_size):
+    """Score triples against all candidate entities, in chunks of entities.
+    This avoids materializing intermediate tensors of size (B, N, dim) in
+    the score function, keeping them at (B, chunk_size, dim).
+
+    Args:
+        score_fn: callable, one of the score functions in models.py
+        ent_emb: (1, N, dim) tensor with embeddings of all N candidates
+        embs: (B, 1, dim) tensor with embeddings of the known entities
+        rels: (B, 1, dim) tensor with relation embeddings
+        predict_heads: bool, if True candidates are scored as heads, and
+            embs are used as tails. Otherwise candidates are scored as tails.
+        chunk_size: int, number of candidate entities scored at a time
+
+    Returns:
+        (B, N) tensor with the score of each candidate
+    """
+    num_candidates = ent_emb.shape[1]
+    scores = torch.empty((embs.shape[0], num_candidates), dtype=embs.dtype,
+                         device=embs.device)
+    for start in range(0, num_candidates, chunk_size):
+        candidates = ent_emb[:, start:start + chunk_size]
+        if predict_heads:
+            chunk_scores = score_fn(candidates, embs, rels)
+        else:
+            chunk_scores = score_fn(embs, candidates, rels)
+        scores[:, start:start + chunk_size] = chunk_scores
+
+    return scores
+
+
 def get_metrics(pred_scores: torch.Tensor,
                 true_idx: torch.Tensor,
                 k_values: torch.Tensor):